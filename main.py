@@ -1,11 +1,22 @@
+import functools
+import hashlib
 import os
+import queue
+import re
+import threading
 import time
+from array import array
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+from itertools import islice
+from urllib.parse import urlsplit, urlunsplit
 from firecrawl import FirecrawlApp
 from google import genai
-from pinecone import Pinecone
+import tiktoken
+from pinecone.grpc import PineconeGRPC
 
 # Configuration from environment variables
-TARGET_URL = os.environ.get('TARGET_URL', 'https://docs.stripe.com/api')
+TARGET_URL = os.environ.get('TARGET_URL', 'https://docs.stripe.com/api')  # Comma-separated for multiple URLs
 PINECONE_API_KEY = os.environ.get('PINECONE_API_KEY')
 GEMINI_API_KEY = os.environ.get('GEMINI_API_KEY')
 FIRECRAWL_API_KEY = os.environ.get('FIRECRAWL_API_KEY')
@@ -13,67 +24,542 @@ INDEX_NAME = os.environ.get('INDEX_NAME', 'stripe-api')
 CRAWL_MODE = os.environ.get('CRAWL_MODE', 'crawl')  # 'single' or 'crawl'
 MAX_PAGES = int(os.environ.get('MAX_PAGES', '5'))  # Max pages when crawling
 
+TARGET_URLS = [url.strip() for url in TARGET_URL.split(',') if url.strip()]
 
-def chunk_text(text, chunk_size=1000, overlap=50):
-    """Split text into overlapping chunks"""
+EMBEDDING_MODEL = 'models/text-embedding-004'
+EMBEDDING_DIMENSION = 768
+EMBED_CONFIG = {'output_dimensionality': EMBEDDING_DIMENSION}
+MIN_PAGE_CHARS = 20  # Pages with less content than this are skipped
+CHUNK_TOKENS = 500  # Tokens per chunk, well under the embedding model's input limit
+CHUNK_OVERLAP_TOKENS = 25  # Tokens shared between consecutive chunks
+BATCH_SIZE = 100  # Chunks per Gemini embedding request
+EMBED_WORKERS = 8  # Concurrent Gemini embedding requests
+EMBED_RETRIES = 5  # Retries of a rate-limited or server-failed embedding batch
+EMBED_RETRY_DELAY = 1  # Seconds before the first retry, doubled on each one after
+MAX_PENDING_UPSERTS = 30  # Concurrent Pinecone upsert requests
+MAX_UPSERT_BATCH = 200  # Queued vectors that trigger an upsert before the flush interval
+UPSERT_FLUSH_INTERVAL = 0.2  # Max seconds a vector waits in the queue for others to join it
+MAX_UPSERT_VECTORS = 1000  # Pinecone limit on vectors per upsert request
+MAX_QUEUED_VECTORS = 2 * MAX_UPSERT_VECTORS  # Vectors waiting for an upsert before add() blocks
+MAX_UPSERT_BYTES = 2_000_000  # Stay under Pinecone's 2 MB upsert request limit
+UPSERT_OVERHEAD_BYTES = 64  # Field names and framing per vector in an upsert request
+MAX_IN_FLIGHT_BATCHES = 2 * EMBED_WORKERS  # Embedding batches held in memory at once
+SCRAPE_WORKERS = 16  # Concurrent Firecrawl requests in single page mode
+CRAWL_POLL_INTERVAL = 2  # Seconds between crawl status checks
+METADATA_TEXT_BYTES = 16 * CHUNK_TOKENS  # Max UTF-8 bytes of chunk text in Pinecone metadata, room for a whole chunk (limit is 40 KB)
+EMBED_CACHE_SIZE = 20000  # Vectors kept in the in-memory embedding cache (~3 KB each as float32)
+
+# Tokenizer for chunking, loaded on first use since tiktoken downloads its BPE file
+_encoding = None
+_encoding_lock = threading.Lock()
+
+# Whitespace cleanup for scraped markdown, compiled once at import
+_MULTISPACE = re.compile(r'(?<=\S)[ \t]{2,}')  # Leading indentation is kept for code blocks
+_MULTINL = re.compile(r'\n{3,}')
+
+
+def clean_markdown(text):
+    """Collapse runs of spaces/tabs within lines and runs of blank lines in scraped markdown"""
+    text = _MULTISPACE.sub(' ', text)
+    return _MULTINL.sub('\n\n', text)
+
+
+def get_encoding():
+    """Return the chunking tokenizer, loading it on first use.
+    
+    Loading it at import would fetch the BPE file on every cold start before the
+    function can serve anything, and fail the import when the download fails."""
+    global _encoding
+    with _encoding_lock:
+        if _encoding is None:
+            _encoding = tiktoken.get_encoding('cl100k_base')
+    return _encoding
+
+
+def chunk_text(text, chunk_size=CHUNK_TOKENS, overlap=CHUNK_OVERLAP_TOKENS):
+    """Split text into overlapping chunks of chunk_size tokens"""
+    text = text.strip() if text else ''
     if not text:
         return []
     
-    chunks = []
-    start = 0
-    
-    while start < len(text):
-        end = start + chunk_size
-        chunk = text[start:end].strip()
-        if chunk:
-            chunks.append(chunk)
-        start += chunk_size - overlap
-    
-    return chunks
+    # Encode once and slice the token ids at a fixed stride. Windows are mapped back to
+    # character offsets and cut from the original text, since decoding a window on its
+    # own would garble characters whose bytes are split across a window boundary.
+    encoding = get_encoding()
+    tokens = encoding.encode_ordinary(text)
+    _, offsets = encoding.decode_with_offsets(tokens)
+    offsets.append(len(text))
+    step = chunk_size - overlap
+    chunks = (text[offsets[start]:offsets[min(start + chunk_size, len(tokens))]].strip() for start in range(0, len(tokens), step))
+    # Whitespace-only windows strip down to '' and would fail the whole embedding batch
+    return [chunk for chunk in chunks if chunk]
 
 
-def scrape_content(url, api_key, mode='single', max_pages=5):
-    """Scrape website using Firecrawl - supports single page or crawl mode"""
-    app = FirecrawlApp(api_key=api_key)
-    results = []
+def scrape_content(app, urls, mode='single', max_pages=5):
+    """Scrape websites using Firecrawl - supports single page or crawl mode.
+    
+    Yields pages as soon as they are scraped so processing can start before scraping finishes."""
+    scraped = 0
     
     if mode == 'crawl':
-        print(f"Crawling website: {url} (max {max_pages} pages)")
-        
-        crawl_result = app.crawl_url(
-            url,
-            params={
-                'limit': max_pages,
-                'scrapeOptions': {
-                    'formats': ['markdown']
-                }
-            }
-        )
+        # Start all crawls without blocking, then poll them for finished pages
+        crawls = {}
+        for url in urls:
+            print(f"Crawling website: {url} (max {max_pages} pages)")
+            try:
+                crawl_job = app.async_crawl_url(
+                    url,
+                    params={
+                        'limit': max_pages,
+                        'scrapeOptions': {
+                            'formats': ['markdown']
+                        }
+                    }
+                )
+            except Exception as e:
+                print(f"Error starting crawl for {url}: {e}")
+                continue
+            
+            if crawl_job and crawl_job.get('id'):
+                crawls[crawl_job['id']] = {'url': url, 'seen': 0}
+            else:
+                print(f"Failed to start crawl for: {url}")
         
-        if crawl_result and 'data' in crawl_result:
-            for page in crawl_result['data']:
-                if 'markdown' in page and page['markdown']:
-                    results.append({
-                        'url': page.get('url', url),
-                        'content': page['markdown']
-                    })
-                    print(f"Crawled: {page.get('url', 'unknown')}")
+        while crawls:
+            for crawl_id, crawl in list(crawls.items()):
+                # A failed poll drops only this crawl, like a failed page in single page mode
+                try:
+                    status = app.check_crawl_status(crawl_id)
+                except Exception as e:
+                    print(f"Error checking crawl for {crawl['url']}: {e}")
+                    del crawls[crawl_id]
+                    continue
+                pages = status.get('data') or []
+                
+                for page in pages[crawl['seen']:]:
+                    if 'markdown' in page and page['markdown']:
+                        # Crawl results carry the page URL in their metadata
+                        page_url = page.get('url') or page.get('metadata', {}).get('sourceURL')
+                        scraped += 1
+                        print(f"Crawled: {page_url or 'unknown'}")
+                        yield {
+                            'url': page_url or crawl['url'],
+                            'content': page['markdown'],
+                            # Pages without their own URL are labelled with the crawl's start URL
+                            'has_url': bool(page_url)
+                        }
+                crawl['seen'] = max(crawl['seen'], len(pages))
+                
+                if status.get('status') in ('completed', 'failed', 'cancelled'):
+                    if status.get('status') != 'completed':
+                        print(f"Crawl {status.get('status')}: {crawl['url']}")
+                    del crawls[crawl_id]
+            
+            if crawls:
+                time.sleep(CRAWL_POLL_INTERVAL)
         
-        print(f"Total pages crawled: {len(results)}")
+        print(f"Total pages crawled: {scraped}")
     
     else:
-        # Single page mode
-        print(f"Scraping single page: {url}")
-        result = app.scrape_url(url, params={'formats': ['markdown']})
+        # Single page mode - scrape all URLs in parallel
+        with ThreadPoolExecutor(max_workers=SCRAPE_WORKERS) as executor:
+            futures = {}
+            for url in urls:
+                print(f"Scraping single page: {url}")
+                futures[executor.submit(app.scrape_url, url, params={'formats': ['markdown']})] = url
+            
+            for future in as_completed(futures):
+                url = futures[future]
+                try:
+                    result = future.result()
+                except Exception as e:
+                    print(f"Error scraping {url}: {e}")
+                    continue
+                
+                if result and 'markdown' in result:
+                    scraped += 1
+                    print(f"Scraped {len(result['markdown'])} characters from {url}")
+                    yield {
+                        'url': url,
+                        'content': result['markdown']
+                    }
+
+
+# Reads vectors out of an embed_content response, picked once from the first response's shape
+_vector_extractor = None
+
+
+def _detect_vector_extractor(response):
+    """Return a function that reads the list of vectors out of responses shaped like this one"""
+    if hasattr(response, 'embedding'):
+        return lambda r: [list(r.embedding)]
+    elif hasattr(response, 'embeddings'):
+        return lambda r: [list(embedding.values) for embedding in r.embeddings]
+    elif isinstance(response, dict) and 'embeddings' in response:
+        return lambda r: [list(embedding['values']) for embedding in r['embeddings']]
+    return None
+
+
+def extract_vectors(response):
+    """Extract the list of vectors from an embed_content response"""
+    global _vector_extractor
+    if _vector_extractor is None:
+        extractor = _detect_vector_extractor(response)
+        if extractor is None:
+            raise ValueError(f"Couldn't extract embeddings from {type(response).__name__} response")
+        _vector_extractor = extractor
+    return _vector_extractor(response)
+
+
+def generate_embedding(client, text, model=EMBEDDING_MODEL):
+    """Generate an embedding for a single text"""
+    response = client.models.embed_content(
+        model=model,
+        contents=text,
+        config=EMBED_CONFIG
+    )
+    return extract_vectors(response)[0]
+
+
+def is_retryable(error):
+    """Whether a Gemini API error is a rate limit or server error that may succeed on retry"""
+    code = getattr(error, 'code', None)
+    return isinstance(code, int) and (code == 429 or code >= 500)
+
+
+def generate_embeddings(client, texts, model=EMBEDDING_MODEL):
+    """Generate embeddings for a batch of texts with a single Gemini request.
+    
+    Returns one vector per text, with None for texts that couldn't be embedded.
+    Rate limits and server errors retry the batch with exponential backoff and are
+    raised once the retries run out. Only a malformed response or an invalid-input
+    error falls back to embedding the texts one at a time."""
+    for attempt in range(EMBED_RETRIES + 1):
+        try:
+            response = client.models.embed_content(
+                model=model,
+                contents=texts,
+                config=EMBED_CONFIG
+            )
+            
+            vectors = extract_vectors(response)
+            if len(vectors) == len(texts):
+                return vectors
+            
+            print(f"Batch embedding returned {len(vectors)} vectors for {len(texts)} chunks, retrying chunks individually")
+        
+        except Exception as e:
+            if is_retryable(e) and attempt < EMBED_RETRIES:
+                delay = EMBED_RETRY_DELAY * 2 ** attempt
+                print(f"Batch embedding failed ({e}), retrying in {delay}s")
+                time.sleep(delay)
+                continue
+            # Errors other than invalid input (auth, quota, exhausted retries) would fail every text too
+            code = getattr(e, 'code', None)
+            if code is not None and code != 400:
+                raise
+            print(f"Batch embedding failed ({e}), retrying chunks individually")
+        
+        break
+    
+    # Fall back to one request per chunk so a single bad chunk doesn't lose the batch
+    vectors = []
+    for text in texts:
+        try:
+            vectors.append(generate_embedding(client, text, model))
+        except Exception as e:
+            print(f"Error embedding chunk: {e}")
+            vectors.append(None)
+    
+    return vectors
+
+
+class CachedEmbedder:
+    """Generates embeddings, skipping texts that have already been embedded.
+    
+    Each text is keyed by a SHA-256 hash of the model name and the text. Vectors are
+    looked up in an in-memory LRU cache first and then in Pinecone, which stores them
+    under the same hash as their id, so only cache misses are sent to Gemini.
+    
+    Cached vectors are kept as float32 arrays, about an eighth of the size of a list
+    of Python floats, since the cache lives on across warm invocations."""
+    
+    def __init__(self, client, index, model=EMBEDDING_MODEL, maxsize=EMBED_CACHE_SIZE):
+        self.client = client
+        self.index = index
+        self.model = model
+        self.maxsize = maxsize
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        # Hash state for the model prefix, copied per text instead of rehashing the prefix
+        self._key_hash = hashlib.sha256(f"{model}\0".encode('utf-8'))
+    
+    def key(self, text):
+        """Content hash used as both the cache key and the Pinecone vector id"""
+        key_hash = self._key_hash.copy()
+        key_hash.update(text.encode('utf-8'))
+        return key_hash.hexdigest()
+    
+    def _get(self, key):
+        with self._lock:
+            vector = self._cache.get(key)
+            if vector is not None:
+                self._cache.move_to_end(key)
+            return vector
+    
+    def _put(self, key, vector):
+        with self._lock:
+            self._cache[key] = array('f', vector)
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.maxsize:
+                self._cache.popitem(last=False)
+    
+    def embed(self, texts, keys=None):
+        """Return one vector (a list or float32 array) per text, with None for texts that couldn't be embedded.
+        
+        keys can be passed when the caller has already computed them with key()."""
+        if keys is None:
+            keys = [self.key(text) for text in texts]
+        vectors = [self._get(key) for key in keys]
+        missing = [i for i, vector in enumerate(vectors) if vector is None]
+        
+        # Vectors upserted by earlier runs can be fetched back by their hash id
+        if missing:
+            try:
+                stored = self.index.fetch(ids=[keys[i] for i in missing]).vectors
+            except Exception as e:
+                print(f"Embedding cache lookup failed: {e}")
+                stored = {}
+            
+            for i in missing:
+                if keys[i] in stored:
+                    vectors[i] = list(stored[keys[i]].values)
+            missing = [i for i in missing if vectors[i] is None]
+        
+        if missing:
+            new_vectors = generate_embeddings(self.client, [texts[i] for i in missing], self.model)
+            for i, vector in zip(missing, new_vectors):
+                vectors[i] = vector
+        
+        for key, vector in zip(keys, vectors):
+            if vector is not None:
+                self._put(key, vector)
         
-        if result and 'markdown' in result:
-            results.append({
-                'url': url,
-                'content': result['markdown']
-            })
-            print(f"Scraped {len(result['markdown'])} characters")
+        return vectors
+
+
+class BatchUpserter:
+    """Merges vectors from finished embedding batches into larger Pinecone upserts.
+    
+    A background thread collects queued vectors until MAX_UPSERT_BATCH are waiting or
+    UPSERT_FLUSH_INTERVAL has passed since the first one arrived, then sends everything
+    queued (up to MAX_UPSERT_VECTORS) in as few upserts as Pinecone's request limits
+    allow. The queue is bounded, so when upserts fall behind, add() blocks the embedding
+    workers instead of letting vectors pile up in memory."""
+    
+    _STOP = object()
     
-    return results if results else None
+    def __init__(self, index, max_batch=MAX_UPSERT_BATCH, interval=UPSERT_FLUSH_INTERVAL):
+        self.index = index
+        self.max_batch = max_batch
+        self.interval = interval
+        self.uploaded = 0
+        self._queue = queue.Queue(maxsize=MAX_QUEUED_VECTORS)
+        self._pending = deque()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+    
+    def add(self, vectors):
+        """Queue upsert payload dicts for the next flush, blocking while the queue is full"""
+        for vector in vectors:
+            self._queue.put(vector)
+    
+    def close(self):
+        """Flush everything still queued, wait for all upserts and return the number uploaded"""
+        self._queue.put(self._STOP)
+        self._thread.join()
+        while self._pending:
+            self._finish()
+        return self.uploaded
+    
+    def _run(self):
+        stopping = False
+        while not stopping:
+            # Block until a vector arrives, then give the batch up to the flush interval to fill
+            buffer = []
+            deadline = None
+            while len(buffer) < self.max_batch:
+                timeout = None if deadline is None else deadline - time.monotonic()
+                if timeout is not None and timeout <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is self._STOP:
+                    stopping = True
+                    break
+                buffer.append(item)
+                if deadline is None:
+                    deadline = time.monotonic() + self.interval
+            
+            # Merge in anything else that queued up meanwhile, up to one full upsert
+            while not stopping and len(buffer) < MAX_UPSERT_VECTORS:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is self._STOP:
+                    stopping = True
+                else:
+                    buffer.append(item)
+            
+            self._flush(buffer)
+    
+    def _flush(self, buffer):
+        batch = []
+        batch_bytes = 0
+        for vector in buffer:
+            size = upsert_size(vector)
+            if batch and (len(batch) >= MAX_UPSERT_VECTORS or batch_bytes + size > MAX_UPSERT_BYTES):
+                self._send(batch)
+                batch = []
+                batch_bytes = 0
+            batch.append(vector)
+            batch_bytes += size
+        if batch:
+            self._send(batch)
+    
+    def _send(self, batch):
+        try:
+            # Non-blocking gRPC upsert, multiplexed over the index's HTTP/2 channel
+            self._pending.append((self.index.upsert(vectors=batch, async_req=True), len(batch)))
+        except Exception as e:
+            print(f"Error uploading batch: {e}")
+            return
+        if len(self._pending) > MAX_PENDING_UPSERTS:
+            self._finish()
+    
+    def _finish(self):
+        upsert_future, count = self._pending.popleft()
+        try:
+            upsert_future.result()
+            self.uploaded += count
+            print(f"Uploaded {self.uploaded} chunks")
+        except Exception as e:
+            print(f"Error uploading batch: {e}")
+
+
+# API clients, created on first use and reused by warm invocations
+_firecrawl = None
+_gemini = None
+_pc = None
+_index = None
+_embedder = None
+_clients_lock = threading.Lock()
+
+
+def get_clients():
+    """Return the Firecrawl app, Pinecone index and embedder, creating them on first use.
+    
+    They're kept at module level so warm invocations reuse their connection pools
+    and the embedder's in-memory cache instead of reconnecting every time."""
+    global _firecrawl, _gemini, _pc, _index, _embedder
+    with _clients_lock:
+        if _firecrawl is None:
+            _firecrawl = FirecrawlApp(api_key=FIRECRAWL_API_KEY)
+        if _gemini is None:
+            _gemini = genai.Client(api_key=GEMINI_API_KEY)
+        if _pc is None:
+            _pc = PineconeGRPC(api_key=PINECONE_API_KEY)
+        if _index is None:
+            _index = _pc.Index(INDEX_NAME)
+        if _embedder is None:
+            _embedder = CachedEmbedder(_gemini, _index)
+    return _firecrawl, _index, _embedder
+
+
+def normalize_url(url):
+    """Normalize a URL for duplicate detection - drops the fragment and trailing slashes"""
+    parts = urlsplit(url)
+    return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path.rstrip('/'), parts.query, ''))
+
+
+def unique_pages(pages):
+    """Yield (url, content) for every page worth chunking, with its markdown cleaned.
+    
+    Pages whose URL was already seen and pages with (almost) no content are skipped.
+    Pages without a URL of their own are never treated as duplicates."""
+    seen_urls = set()
+    for page in pages:
+        has_url = page.get('has_url', True)
+        page_url = normalize_url(page['url'])
+        if has_url and page_url in seen_urls:
+            print(f"Skipping duplicate page: {page['url']}")
+            continue
+        
+        # Clean the whole page once, not each chunk
+        content = clean_markdown(page['content']).strip()
+        if len(content) < MIN_PAGE_CHARS:
+            continue
+        if has_url:
+            seen_urls.add(page_url)
+        
+        yield page['url'], content
+
+
+def iter_chunks(pages):
+    """Yield (source, text) for every chunk of every (url, content) page, one page at a time"""
+    for url, content in pages:
+        for chunk in chunk_text(content):
+            yield url, chunk
+
+
+def truncate_utf8(text, max_bytes):
+    """Truncate text to at most max_bytes of UTF-8, dropping any partial trailing character"""
+    # Every character is at least one byte, so only the first max_bytes characters can fit
+    return text[:max_bytes].encode('utf-8')[:max_bytes].decode('utf-8', errors='ignore')
+
+
+def unique_chunks(chunks, embedder, seen_ids):
+    """Yield (source, text, vector_id) for chunks whose content hash isn't in seen_ids yet.
+    
+    Repeated chunks (navigation, footers, shared snippets) would be stored under the
+    same content hash id anyway, so only the first occurrence is embedded."""
+    for source, text in chunks:
+        vector_id = embedder.key(text)
+        if vector_id in seen_ids:
+            continue
+        seen_ids.add(vector_id)
+        yield source, text, vector_id
+
+
+def upsert_size(vector):
+    """Approximate request bytes for one upsert payload dict (float32 values plus id and metadata)"""
+    metadata = vector['metadata']
+    return (4 * len(vector['values']) + len(vector['id']) + len(metadata['text'].encode('utf-8'))
+            + len(metadata['source'].encode('utf-8')) + UPSERT_OVERHEAD_BYTES)
+
+
+def build_vectors(group, vectors, start):
+    """Build the Pinecone upsert payload for a batch of (source, text, vector_id) chunks"""
+    batch = []
+    for i, ((source, text, vector_id), vector) in enumerate(zip(group, vectors), start):
+        if vector is None:
+            print(f"Skipping chunk {i}: couldn't extract embedding")
+            continue
+        
+        # Content hash ids make re-ingests update vectors in place instead of duplicating them
+        batch.append({
+            'id': vector_id,
+            'values': list(vector),
+            'metadata': {
+                'text': truncate_utf8(text, METADATA_TEXT_BYTES),
+                'source': source
+            }
+        })
+    
+    return batch
 
 
 def ingest_data(request):
@@ -84,84 +570,81 @@ def ingest_data(request):
         return "Error: Missing API keys", 500
     
     try:
-        print(f"Starting ingestion for: {TARGET_URL} (mode: {CRAWL_MODE})")
+        print(f"Starting ingestion for: {', '.join(TARGET_URLS)} (mode: {CRAWL_MODE})")
         
-        # Step 1: Scrape website with Firecrawl
-        scraped_pages = scrape_content(TARGET_URL, FIRECRAWL_API_KEY, CRAWL_MODE, MAX_PAGES)
+        # Step 1: Get the Firecrawl, Gemini and Pinecone clients
+        firecrawl_app, index, embedder = get_clients()
         
-        if not scraped_pages:
-            return "Error: Failed to scrape content", 500
+        page_count = 0
+        kept_pages = 0
+        total_chunks = 0
+        chunk_count = 0
+        in_flight = set()
+        seen_ids = set()
         
-        # Step 2: Process all pages and create chunks
-        all_chunks = []
-        for page in scraped_pages:
-            chunks = chunk_text(page['content'])
-            for chunk in chunks:
-                all_chunks.append({
-                    'text': chunk,
-                    'source': page['url']
-                })
+        def scraped_pages():
+            nonlocal page_count
+            for page in scrape_content(firecrawl_app, TARGET_URLS, CRAWL_MODE, MAX_PAGES):
+                page_count += 1
+                yield page
         
-        print(f"Created {len(all_chunks)} chunks from {len(scraped_pages)} pages")
+        def ingested_pages():
+            nonlocal kept_pages
+            for page in unique_pages(scraped_pages()):
+                kept_pages += 1
+                yield page
         
-        if not all_chunks:
-            return "No content to process", 200
-        
-        # Step 3: Initialize Gemini and Pinecone
-        gemini_client = genai.Client(api_key=GEMINI_API_KEY)
-        pc = Pinecone(api_key=PINECONE_API_KEY)
-        index = pc.Index(INDEX_NAME)
+        def counted_chunks():
+            nonlocal total_chunks
+            for chunk in iter_chunks(ingested_pages()):
+                total_chunks += 1
+                yield chunk
         
-        # Step 4: Generate embeddings and upload to Pinecone
-        uploaded = 0
-        batch = []
+        def upload_batch(group, start, future):
+            # Runs as soon as the batch is embedded; failures are re-raised from in_flight below
+            if future.exception() is None:
+                upserter.add(build_vectors(group, future.result(), start))
         
-        for i, chunk_data in enumerate(all_chunks):
-            try:
-                # Generate embedding
-                response = gemini_client.models.embed_content(
-                    model='models/text-embedding-004',
-                    contents=chunk_data['text']
-                )
-                
-                # Extract vector
-                if hasattr(response, 'embedding'):
-                    vector = list(response.embedding)
-                elif hasattr(response, 'embeddings'):
-                    vector = list(response.embeddings[0].values)
-                else:
-                    print(f"Skipping chunk {i}: couldn't extract embedding")
-                    continue
-                
-                # Add to batch
-                batch.append({
-                    'id': f'chunk-{i}',
-                    'values': vector,
-                    'metadata': {
-                        'text': chunk_data['text'][:500],
-                        'source': chunk_data['source']
-                    }
-                })
+        upserter = BatchUpserter(index)
+        try:
+            with ThreadPoolExecutor(max_workers=EMBED_WORKERS) as executor:
+                # Step 2: Stream pages from Firecrawl into chunks and embed them one batch at a
+                # time, keeping only a bounded number of batches in memory
+                chunks = unique_chunks(counted_chunks(), embedder, seen_ids)
                 
-                # Upload in batches of 50
-                if len(batch) >= 50:
-                    index.upsert(vectors=batch)
-                    uploaded += len(batch)
-                    print(f"Uploaded {uploaded} chunks")
-                    batch = []
-                    time.sleep(0.5)  # Small delay to avoid rate limits
+                while True:
+                    group = list(islice(chunks, BATCH_SIZE))
+                    if not group:
+                        break
+                    
+                    future = executor.submit(embedder.embed, [text for _, text, _ in group], [vector_id for _, _, vector_id in group])
+                    # Step 3: Upload batches to Pinecone as soon as their embeddings are ready
+                    future.add_done_callback(functools.partial(upload_batch, group, chunk_count))
+                    in_flight.add(future)
+                    chunk_count += len(group)
+                    
+                    if len(in_flight) >= MAX_IN_FLIGHT_BATCHES:
+                        done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            future.result()
                 
-            except Exception as e:
-                print(f"Error on chunk {i}: {e}")
-                continue
+                for future in as_completed(in_flight):
+                    future.result()
+        finally:
+            # Step 4: Flush the remaining vectors and wait for all uploads to finish
+            uploaded = upserter.close()
         
-        # Upload remaining chunks
-        if batch:
-            index.upsert(vectors=batch)
-            uploaded += len(batch)
+        if not page_count:
+            return "Error: Failed to scrape content", 500
+        
+        print(f"Created {total_chunks} chunks from {kept_pages} pages ({page_count - kept_pages} duplicate or empty pages "
+              f"and {total_chunks - chunk_count} duplicate chunks skipped)")
+        
+        if not chunk_count:
+            return "No content to process", 200
         
-        print(f"Complete! Uploaded {uploaded} chunks from {len(scraped_pages)} pages")
-        return f"Success: Uploaded {uploaded} chunks from {len(scraped_pages)} pages to {INDEX_NAME}", 200
+        print(f"Complete! Uploaded {uploaded} chunks from {kept_pages} pages")
+        return f"Success: Uploaded {uploaded} chunks from {kept_pages} pages to {INDEX_NAME}", 200
         
     except Exception as e:
         print(f"Error: {e}")